@@ -7,9 +7,13 @@
 # --------------------------------------------------------------------------
 
 # For live logging, use the command: pytest -o log_cli=true --log-cli-level=DEBUG
+# To run test cases in parallel (pytest-xdist is required), use the command: pytest -n auto
 
-import unittest
 import os
+import sys
+import collections
+import tempfile
+import mmap
 import onnx
 import onnxruntime
 import pytest
@@ -30,190 +34,165 @@ BERT_TEST_MODELS = {
     "gpt2_past": ('gpt2_pytorch1.5_opset11', 'gpt2_past.onnx'),
 }
 
-skip_on_ort_version = pytest.mark.skipif(onnxruntime.__version__.startswith('1.3.'),
-                                         reason="skip failed tests. TODO: fix them in 1.4.0.")
-
+BERT_TEST_MODEL_PATHS = {
+    name: os.path.join('test_data', sub_dir, file)
+    for name, (sub_dir, file) in BERT_TEST_MODELS.items()
+}
 
-def _get_test_model_path(name):
-    sub_dir, file = BERT_TEST_MODELS[name]
-    return os.path.join('test_data', sub_dir, file)
+_SKIP_ORT_13 = onnxruntime.__version__.startswith('1.3.')
+skip_on_ort_version = pytest.mark.skipif(_SKIP_ORT_13, reason="skip failed tests. TODO: fix them in 1.4.0.")
 
+_HAS_CUDA = 'CUDAExecutionProvider' in onnxruntime.get_available_providers()
+skip_without_gpu = pytest.mark.skipif(not _HAS_CUDA, reason="no gpu found")
 
-class TestBertOptimization(unittest.TestCase):
-    def verify_node_count(self, bert_model, expected_node_count, test_name):
-        for op_type, count in expected_node_count.items():
-            if len(bert_model.get_nodes_by_op_type(op_type)) != count:
-                print(f"Counters is not expected in test: {test_name}")
-                for op, counter in expected_node_count.items():
-                    print("{}: {} expected={}".format(op, len(bert_model.get_nodes_by_op_type(op)), counter))
-            self.assertEqual(len(bert_model.get_nodes_by_op_type(op_type)), count)
 
-    @skip_on_ort_version
-    def test_pytorch_model_0_cpu_onnxruntime(self):
-        input = _get_test_model_path('bert_pytorch_0')
-        output = 'temp.onnx'
-        optimize_by_onnxruntime(input, use_gpu=False, optimized_model_path=output)
-        model = ModelProto()
-        with open(output, "rb") as f:
-            model.ParseFromString(f.read())
-        os.remove(output)
-        bert_model = OnnxModel(model)
-        expected_node_count = {
-            'EmbedLayerNormalization': 1,
-            'Attention': 12,
-            'SkipLayerNormalization': 24,
-            'Gelu': 0,
-            'FastGelu': 0,
-            'BiasGelu': 12
-        }
-        self.verify_node_count(bert_model, expected_node_count, 'test_pytorch_model_0_cpu_onnxruntime')
-
-    @skip_on_ort_version
-    def test_pytorch_model_0_gpu_onnxruntime(self):
-        if 'CUDAExecutionProvider' not in onnxruntime.get_available_providers():
-            print("skip test_pytorch_model_0_gpu_onnxruntime since no gpu found")
-            return
-
-        input = _get_test_model_path('bert_pytorch_0')
-        output = 'temp.onnx'
-        optimize_by_onnxruntime(input, use_gpu=True, optimized_model_path=output)
-        model = ModelProto()
-        with open(output, "rb") as f:
-            model.ParseFromString(f.read())
-        os.remove(output)
-        bert_model = OnnxModel(model)
-        expected_node_count = {
-            'EmbedLayerNormalization': 1,
-            'Attention': 12,
-            'SkipLayerNormalization': 24,
-            'Gelu': 0,
-            'FastGelu': 12,
-            'BiasGelu': 0
-        }
-        self.verify_node_count(bert_model, expected_node_count, 'test_pytorch_model_0_gpu_onnxruntime')
-
-    @skip_on_ort_version
-    def test_pytorch_model_1_cpu_onnxruntime(self):
-        input = _get_test_model_path('bert_pytorch_1')
-        output = 'temp.onnx'
-        optimize_by_onnxruntime(input, use_gpu=False, optimized_model_path=output)
-        model = ModelProto()
-        with open(output, "rb") as f:
-            model.ParseFromString(f.read())
-        os.remove(output)
-        bert_model = OnnxModel(model)
-        expected_node_count = {
-            'EmbedLayerNormalization': 1,
-            'Attention': 12,
-            'LayerNormalization': 24,
-            'SkipLayerNormalization': 0,
-            'Gelu': 0,
-            'FastGelu': 0,
-            'BiasGelu': 12
-        }
-        self.verify_node_count(bert_model, expected_node_count, 'test_pytorch_model_1_cpu_onnxruntime')
-
-    @skip_on_ort_version
-    def test_pytorch_model_1_gpu_onnxruntime(self):
-        if 'CUDAExecutionProvider' not in onnxruntime.get_available_providers():
-            print("skip test_pytorch_model_1_gpu_onnxruntime since no gpu found")
-            return
-
-        input = _get_test_model_path('bert_pytorch_1')
-        output = 'temp.onnx'
-        optimize_by_onnxruntime(input, use_gpu=True, optimized_model_path=output)
+def _optimize_inmem(input_path, use_gpu):
+    """
+    Optimize a model by onnxruntime, and return the optimized model as ModelProto.
+    onnxruntime can only save the optimized model to a file, so a unique temporary file is used.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.onnx', delete=False) as f:
+        output = f.name
+    try:
+        optimize_by_onnxruntime(input_path, use_gpu=use_gpu, optimized_model_path=output)
         model = ModelProto()
-        with open(output, "rb") as f:
-            model.ParseFromString(f.read())
+        with open(output, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            with memoryview(buffer) as view:
+                model.ParseFromString(view)
+    finally:
         os.remove(output)
-        bert_model = OnnxModel(model)
-        expected_node_count = {
-            'EmbedLayerNormalization': 1,
-            'Attention': 12,
-            'LayerNormalization': 24,
-            'SkipLayerNormalization': 0,
-            'Gelu': 0,
-            'FastGelu': 12,
-            'BiasGelu': 0
-        }
-        self.verify_node_count(bert_model, expected_node_count, 'test_pytorch_model_1_gpu_onnxruntime')
-
-    @skip_on_ort_version
-    def test_pytorch_model_0(self):
-        input = _get_test_model_path('bert_pytorch_0')
-        bert_model = optimize_model(input, 'bert', num_heads=2, hidden_size=8)
-
-        expected_node_count = {
-            'EmbedLayerNormalization': 1,
-            'Attention': 12,
-            'SkipLayerNormalization': 24,
-            'Gelu': 0,
-            'FastGelu': 0,
-            'BiasGelu': 12
-        }
-        self.verify_node_count(bert_model, expected_node_count, 'test_pytorch_model_0')
-
-    def test_pytorch_model_2(self):
-        input = _get_test_model_path('bert_squad_pytorch1.4_opset10_fp32')
-        bert_model = optimize_model(input, 'bert', num_heads=2, hidden_size=8)
-        print("fused_operator_statistics for test_pytorch_model_2", bert_model.get_fused_operator_statistics())
-        self.assertTrue(bert_model.is_fully_optimized())
-
-    def test_keras_model_1(self):
-        input = _get_test_model_path('bert_keras_0')
-
-        bert_model = optimize_model(input, 'bert_keras', num_heads=2, hidden_size=8)
-
-        expected_node_count = {
-            'EmbedLayerNormalization': 1,
-            'Attention': 12,
-            'LayerNormalization': 0,
-            'SkipLayerNormalization': 24,
-            'BiasGelu': 12,
-            'Gelu': 0,
-            'FastGelu': 0
-        }
-        self.verify_node_count(bert_model, expected_node_count, 'test_keras_model_1')
-
-    def test_keras_squad_model(self):
-        input = _get_test_model_path('bert_keras_squad')
-
-        bert_model = optimize_model(input, 'bert_keras', num_heads=2, hidden_size=8)
-
-        print("fused_operator_statistics for test_keras_squad_model", bert_model.get_fused_operator_statistics())
-
-        self.assertTrue(bert_model.is_fully_optimized())
-
-    def test_gpt2(self):
-        input = _get_test_model_path('gpt2')
-        bert_model = optimize_model(input, 'gpt2', num_heads=2, hidden_size=4)
-
-        expected_node_count = {
-            'EmbedLayerNormalization': 0,
-            'Attention': 12,
-            'Gelu': 0,
-            'FastGelu': 12,
-            'BiasGelu': 0,
-            'LayerNormalization': 25,
-            'SkipLayerNormalization': 0
-        }
-        self.verify_node_count(bert_model, expected_node_count, 'test_gpt2')
-
-    def test_gpt2_past(self):
-        input = _get_test_model_path('gpt2_past')
-        bert_model = optimize_model(input, 'gpt2', num_heads=2, hidden_size=4)
-
-        expected_node_count = {
-            'EmbedLayerNormalization': 0,
-            'Attention': 12,
-            'Gelu': 0,
-            'FastGelu': 12,
-            'BiasGelu': 0,
-            'LayerNormalization': 25,
-            'SkipLayerNormalization': 0
-        }
-        self.verify_node_count(bert_model, expected_node_count, 'test_gpt2_past')
+    return model
+
+
+def verify_node_count(bert_model, expected_node_count, test_name):
+    counts = collections.Counter(node.op_type for node in bert_model.nodes())
+    actual_node_count = {op_type: counts[op_type] for op_type in expected_node_count}
+    if actual_node_count != expected_node_count:
+        print(f"Counters is not expected in test: {test_name}")
+        for op, counter in expected_node_count.items():
+            print("{}: {} expected={}".format(op, actual_node_count[op], counter))
+    assert actual_node_count == expected_node_count
+
+
+ONNXRUNTIME_TEST_CASES = [
+    pytest.param('bert_pytorch_0', False, {
+        'EmbedLayerNormalization': 1,
+        'Attention': 12,
+        'SkipLayerNormalization': 24,
+        'Gelu': 0,
+        'FastGelu': 0,
+        'BiasGelu': 12
+    }, id='pytorch_model_0_cpu_onnxruntime'),
+    pytest.param('bert_pytorch_0', True, {
+        'EmbedLayerNormalization': 1,
+        'Attention': 12,
+        'SkipLayerNormalization': 24,
+        'Gelu': 0,
+        'FastGelu': 12,
+        'BiasGelu': 0
+    }, id='pytorch_model_0_gpu_onnxruntime', marks=skip_without_gpu),
+    pytest.param('bert_pytorch_1', False, {
+        'EmbedLayerNormalization': 1,
+        'Attention': 12,
+        'LayerNormalization': 24,
+        'SkipLayerNormalization': 0,
+        'Gelu': 0,
+        'FastGelu': 0,
+        'BiasGelu': 12
+    }, id='pytorch_model_1_cpu_onnxruntime'),
+    pytest.param('bert_pytorch_1', True, {
+        'EmbedLayerNormalization': 1,
+        'Attention': 12,
+        'LayerNormalization': 24,
+        'SkipLayerNormalization': 0,
+        'Gelu': 0,
+        'FastGelu': 12,
+        'BiasGelu': 0
+    }, id='pytorch_model_1_gpu_onnxruntime', marks=skip_without_gpu),
+]
+
+
+@skip_on_ort_version
+@pytest.mark.parametrize("name,use_gpu,expected_node_count", ONNXRUNTIME_TEST_CASES)
+def test_optimize_by_onnxruntime(request, name, use_gpu, expected_node_count):
+    bert_model = OnnxModel(_optimize_inmem(BERT_TEST_MODEL_PATHS[name], use_gpu))
+    verify_node_count(bert_model, expected_node_count, request.node.name)
+
+
+@skip_on_ort_version
+def test_pytorch_model_0():
+    bert_model = optimize_model(BERT_TEST_MODEL_PATHS['bert_pytorch_0'], 'bert', num_heads=2, hidden_size=8)
+
+    expected_node_count = {
+        'EmbedLayerNormalization': 1,
+        'Attention': 12,
+        'SkipLayerNormalization': 24,
+        'Gelu': 0,
+        'FastGelu': 0,
+        'BiasGelu': 12
+    }
+    verify_node_count(bert_model, expected_node_count, 'test_pytorch_model_0')
+
+
+def test_pytorch_model_2():
+    input = BERT_TEST_MODEL_PATHS['bert_squad_pytorch1.4_opset10_fp32']
+    bert_model = optimize_model(input, 'bert', num_heads=2, hidden_size=8)
+    print("fused_operator_statistics for test_pytorch_model_2", bert_model.get_fused_operator_statistics())
+    assert bert_model.is_fully_optimized()
+
+
+def test_keras_model_1():
+    bert_model = optimize_model(BERT_TEST_MODEL_PATHS['bert_keras_0'], 'bert_keras', num_heads=2, hidden_size=8)
+
+    expected_node_count = {
+        'EmbedLayerNormalization': 1,
+        'Attention': 12,
+        'LayerNormalization': 0,
+        'SkipLayerNormalization': 24,
+        'BiasGelu': 12,
+        'Gelu': 0,
+        'FastGelu': 0
+    }
+    verify_node_count(bert_model, expected_node_count, 'test_keras_model_1')
+
+
+def test_keras_squad_model():
+    bert_model = optimize_model(BERT_TEST_MODEL_PATHS['bert_keras_squad'], 'bert_keras', num_heads=2, hidden_size=8)
+
+    print("fused_operator_statistics for test_keras_squad_model", bert_model.get_fused_operator_statistics())
+
+    assert bert_model.is_fully_optimized()
+
+
+def test_gpt2():
+    bert_model = optimize_model(BERT_TEST_MODEL_PATHS['gpt2'], 'gpt2', num_heads=2, hidden_size=4)
+
+    expected_node_count = {
+        'EmbedLayerNormalization': 0,
+        'Attention': 12,
+        'Gelu': 0,
+        'FastGelu': 12,
+        'BiasGelu': 0,
+        'LayerNormalization': 25,
+        'SkipLayerNormalization': 0
+    }
+    verify_node_count(bert_model, expected_node_count, 'test_gpt2')
+
+
+def test_gpt2_past():
+    bert_model = optimize_model(BERT_TEST_MODEL_PATHS['gpt2_past'], 'gpt2', num_heads=2, hidden_size=4)
+
+    expected_node_count = {
+        'EmbedLayerNormalization': 0,
+        'Attention': 12,
+        'Gelu': 0,
+        'FastGelu': 12,
+        'BiasGelu': 0,
+        'LayerNormalization': 25,
+        'SkipLayerNormalization': 0
+    }
+    verify_node_count(bert_model, expected_node_count, 'test_gpt2_past')
 
 
 if __name__ == '__main__':
-    unittest.main()
+    sys.exit(pytest.main([__file__]))